@@ -1,4 +1,5 @@
 from .bootload import BootloaderHost
+from .bootload import VerifyMode
 from .cyacd import BootloaderData
 
 from .protocol import SerialTransport
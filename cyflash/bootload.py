@@ -4,8 +4,12 @@
     This module is what contains the userspace bootloader host class
 """
 
+import itertools
 import logging
+import operator
+import sys
 import typing
+from collections import deque
 from enum import Enum
 from dataclasses import dataclass
 from collections.abc import Callable
@@ -32,6 +36,16 @@ class BootloaderHostError(Exception):
         super().__init__(msg)
 
 
+class VerifyMode(Enum):
+    """How :func:`BootloaderHost.write_rows` verifies the written rows"""
+    per_row = 'per_row'
+    """Read back every row's checksum right after programming it"""
+    bulk = 'bulk'
+    """Program every row first, then read back all the row checksums"""
+    final_only = 'final_only'
+    """Only verify the application checksum, the row checksums are read back only to find the failing row"""
+
+
 class BootloaderHost(object):
     @dataclass
     class MetadataAppVersionError:
@@ -46,7 +60,8 @@ class BootloaderHost(object):
         firmware_id: int
 
     def __init__(self, transport: typing.Union[protocol.SerialTransport, protocol.CANbusTransport], data: cyacd.BootloaderData,
-                 chunck_size: int = 25, key: list = None, is_dual_app: bool = False, is_psoc5: bool = False):
+                 chunck_size: int = 25, key: list = None, is_dual_app: bool = False, is_psoc5: bool = False,
+                 window_size: int = 1, verify_mode: typing.Union[VerifyMode, str] = None):
         """
         Args:
             transport: The transport to send the data over. Right now only SerialTransport and CANbusTransport are
@@ -55,6 +70,14 @@ class BootloaderHost(object):
             key: The bootloader's secret key if applicable. Defaults to None
             chunck_size: The size of a each transfer chuck. Defaults to 25
             is_dual_app: Whether the bootloader is a dual application. Defaults to False
+            window_size: The maximum number of rows in flight when writing rows. A window of 1 waits for every
+                         response before sending the next command, as the bootloader protocol expects. Larger
+                         windows are experimental, a bootloader may read several queued packets as one. Transports
+                         that don't support pipelining always use a window of 1. Defaults to 1
+            verify_mode: How the written rows are verified, see :class:`VerifyMode`. `final_only` saves a round trip
+                         per row in the common case where the flashing succeeded. Defaults to `per_row`, except for a
+                         CANbusTransport with echo frames where the link layer already confirms every frame and
+                         `final_only` is used
         """
         self._log = logging.getLogger('Bootloader Host')
         self.transport = transport
@@ -64,7 +87,18 @@ class BootloaderHost(object):
         self.session = protocol.BootloaderSession(self.transport, self.data.checksum_type)
         self.chunk_size = chunck_size
         self.dual_app = is_dual_app
+        self.window_size = window_size if getattr(transport, 'PIPELINING', False) else 1
+        if verify_mode is None:
+            if isinstance(transport, protocol.CANbusTransport) and transport.echo_frames:
+                verify_mode = VerifyMode.final_only
+            else:
+                verify_mode = VerifyMode.per_row
+        self.verify_mode = VerifyMode(verify_mode)
         self.row_ranges = {}
+        self.last_array_id = None
+        self.last_row_id = None
+        self._row_plan = None
+        self._progress_tty = sys.stderr is not None and sys.stderr.isatty()
 
     def verify_checksum(self):
         """
@@ -88,7 +122,7 @@ class BootloaderHost(object):
         """
         if not self.dual_app:
             raise UserWarning("Command only valid for dual application")
-        self._log.info("Setting application %d as active." % application_id)
+        self._log.info("Setting application %d as active.", application_id)
         self.session.set_application_active(application_id)
 
     def get_application_inactive(self):
@@ -104,13 +138,13 @@ class BootloaderHost(object):
         to_flash = None
         for app in [0, 1]:
             app_valid, app_active = self.session.application_status(app)
-            self._log.debug("App %d: valid: %s, active: %s" % (app, app_valid, app_active))
+            self._log.debug("App %d: valid: %s, active: %s", app, app_valid, app_active)
             if app_active == 0:
                 to_flash = app
 
         if to_flash is None:
             raise BootloaderHostError("Failed to find inactive app to flash. Aborting.")
-        self._log.debug("Will flash app %d.\n" % to_flash)
+        self._log.debug("Will flash app %d.\n", to_flash)
         return to_flash
 
     def verify_row_ranges(self):
@@ -120,16 +154,34 @@ class BootloaderHost(object):
         Raises:
             BootloaderHostError: When the row an the firmware is out of range of the chip's rows
         """
-        for array_id, array in self.data.arrays.items():
-            start_row, end_row = self.session.get_flash_size(array_id)
-            self._log.debug("Array %d: first row %d, last row %d." % (
-                array_id, start_row, end_row))
+        array_ids = list(self.data.arrays)
+        if self.window_size > 1:
+            # Query all the arrays back to back and read the responses in order
+            for array_id in array_ids:
+                self.session.get_flash_size_nowait(array_id)
+            flash_sizes = []
+            pending = len(array_ids)
+            try:
+                while pending:
+                    pending -= 1
+                    flash_sizes.append(self.session.read_flash_size())
+            finally:
+                # Leave the link in sync if a response failed
+                self.session.discard_responses(pending)
+        else:
+            flash_sizes = [self.session.get_flash_size(array_id) for array_id in array_ids]
+        for array_id, (start_row, end_row) in zip(array_ids, flash_sizes):
+            array = self.data.arrays[array_id]
+            self._log.debug("Array %d: first row %d, last row %d.", array_id, start_row, end_row)
             self.row_ranges[array_id] = (start_row, end_row)
-            for row_number in array:
-                if row_number < start_row or row_number > end_row:
-                    err = "Row %d in array %d out of range. Aborting." % (row_number, array_id)
-                    self._log.error(err)
-                    raise BootloaderHostError(err)
+            if min(array) < start_row or max(array) > end_row:
+                bad_row = next(r for r in array if r < start_row or r > end_row)
+                err = "Row %d in array %d out of range. Aborting." % (bad_row, array_id)
+                self._log.error(err)
+                raise BootloaderHostError(err)
+        # The metadata lives in the last row of the last flash array
+        self.last_array_id = max(self.data.arrays)
+        self.last_row_id = self.row_ranges[self.last_array_id][1]
 
     def erase_all_rows(self, array_id):
         """
@@ -141,7 +193,7 @@ class BootloaderHost(object):
         start_row, end_row = self.session.get_flash_size(array_id)
         for row_id in range(start_row, end_row):
             self.session.erase_row(array_id, row_id)
-            self._log.debug(f"Erased row {row_id}")
+            self._log.debug("Erased row %d", row_id)
 
     def enter_bootloader(self):
         """
@@ -153,14 +205,14 @@ class BootloaderHost(object):
         """
         self._log.info("Initialising bootloader.")
         silicon_id, silicon_rev, bootloader_version = self.session.enter_bootloader(self.key)
-        self._log.info("Silicon ID 0x%.8x, revision %d." % (silicon_id, silicon_rev))
+        self._log.info("Silicon ID 0x%.8x, revision %d.", silicon_id, silicon_rev)
         if silicon_id != self.data.silicon_id:
-            self._log.error("Silicon ID of device (0x%.8x) does not match firmware file (0x%.8x)"
-                            % (silicon_id, self.data.silicon_id))
+            self._log.error("Silicon ID of device (0x%.8x) does not match firmware file (0x%.8x)",
+                            silicon_id, self.data.silicon_id)
             raise BootloaderSiliconMismatch('id')
         if silicon_rev != self.data.silicon_rev:
-            self._log.error("Silicon revision of device (0x%.2x) does not match firmware file (0x%.2x)"
-                            % (silicon_rev, self.data.silicon_rev))
+            self._log.error("Silicon revision of device (0x%.2x) does not match firmware file (0x%.2x)",
+                            silicon_rev, self.data.silicon_rev)
             raise BootloaderSiliconMismatch('rev')
 
     def exit_bootloader(self):
@@ -191,31 +243,36 @@ class BootloaderHost(object):
             metadata = self.session.get_psoc5_metadata(0)
         else:
             metadata = self.session.get_metadata(0)
-        self._log.debug("Device application_id %d, version %d." % (
-            metadata.app_id, metadata.app_version))
+        self._log.debug("Device application_id %d, version %d.", metadata.app_id, metadata.app_version)
 
         # TODO: Make this less horribly hacky
         # Fetch from last row of last flash array
-        metadata_row = self.data.arrays[max(self.data.arrays.keys())][self.row_ranges[max(self.data.arrays.keys())][1]]
+        last_array_id = self.last_array_id
+        if last_array_id is None:
+            last_array_id = max(self.data.arrays)
+            last_row_id = self.row_ranges[last_array_id][1]
+        else:
+            last_row_id = self.last_row_id
+        metadata_row = self.data.arrays[last_array_id][last_row_id]
         if self.is_psoc5:
             local_metadata = protocol.GetPSOC5MetadataResponse(metadata_row.data[192:192 + 56])
         else:
             local_metadata = protocol.GetMetadataResponse(metadata_row.data[64:120])
+        device_version, local_version = metadata.app_version, local_metadata.app_version
+        device_id, local_id = metadata.app_id, local_metadata.app_id
 
         if not ignore_app_version:
-            if metadata.app_version > local_metadata.app_version:
-                message = "Device application version is v%d.%d, but local application version is v%d.%d." % (
-                    metadata.app_version >> 8, metadata.app_version & 0xFF,
-                    local_metadata.app_version >> 8, local_metadata.app_version & 0xFF)
-                self._log.warning(message)
-                err_ret.append(self.MetadataAppVersionError(metadata.app_version, local_metadata.app_version))
+            if device_version > local_version:
+                self._log.warning("Device application version is v%d.%d, but local application version is v%d.%d.",
+                                  device_version >> 8, device_version & 0xFF,
+                                  local_version >> 8, local_version & 0xFF)
+                err_ret.append(self.MetadataAppVersionError(device_version, local_version))
 
         if not ignore_app_id:
-            if metadata.app_id != local_metadata.app_id:
-                message = "Device application ID is %d, but local application ID is %d." % (
-                    metadata.app_id, local_metadata.app_id)
-                self._log.warning(message)
-                err_ret.append(self.MetadataIDError(metadata.app_id, local_metadata.app_id))
+            if device_id != local_id:
+                self._log.warning("Device application ID is %d, but local application ID is %d.",
+                                  device_id, local_id)
+                err_ret.append(self.MetadataIDError(device_id, local_id))
 
         return err_ret
 
@@ -224,32 +281,140 @@ class BootloaderHost(object):
         Writes the firmware rows to the device
 
         Args:
-            progress_def: Optional callback that will be called per row to update the user application.
+            progress_def: Optional callback that will be called every 1% of the rows to update the user application.
                           The callback must take 3 arguments, a string with a message, an integer with the
                           current row, and an integer with the total rows
+
+        Raises:
+            BootloaderHostError: When a row checksum doesn't match, or the application checksum when it's the only
+                                 one verified and no row is found faulty
         """
         if progress_def is None:
             progress_def = self._progress
-        total = sum(len(x) for x in self.data.arrays.values())
+        if self._row_plan is None:
+            # Built once and reused if write_rows is retried
+            self._row_plan = [(array_id, row_number, row)
+                              for array_id, array in self.data.arrays.items()
+                              for row_number, row in array.items()]
+        plan = self._row_plan
+        total = len(plan)
         progress_def("Total Rows and Array", 0, total)
-        i = 0
-        for array_id, array in self.data.arrays.items():
-            for row_number, row in array.items():
-                i += 1
-                self.session.program_row(array_id, row_number, row.data, self.chunk_size)
-                actual_checksum = self.session.get_row_checksum(array_id, row_number)
-                if actual_checksum != row.checksum:
-                    err = "Checksum does not match in array %d row %d. Expected %.2x, got %.2x! Aborting." % (
-                            array_id, row_number, row.checksum, actual_checksum)
-                    self._log.error(err)
-                    raise BootloaderHostError(err)
-                progress_def("Uploading data", i, total)
+        # Only report progress every 1% of the rows
+        step = max(1, total // 100)
+        chunk_size = self.chunk_size
+        check_row_checksum = self._check_row_checksum
+        verify_per_row = self.verify_mode == VerifyMode.per_row
+        if self.window_size <= 1:
+            program_row = self.session.program_row
+            get_row_checksum = self.session.get_row_checksum
+            for i, (array_id, row_number, row) in enumerate(plan, 1):
+                program_row(array_id, row_number, row.data, chunk_size)
+                if verify_per_row:
+                    check_row_checksum(array_id, row_number, row, get_row_checksum(array_id, row_number))
+                if i % step == 0 or i == total:
+                    progress_def("Uploading data", i, total)
+        else:
+            # Keep up to window_size rows in flight, the responses are read back in order so a checksum failure is
+            # still reported on the exact row. Every row keeps count of its unread responses
+            program_row_nowait = self.session.program_row_nowait
+            get_row_checksum_nowait = self.session.get_row_checksum_nowait
+            read_row_responses = self._read_row_responses
+            window_size = self.window_size
+            outstanding = deque()
+            i = 0
+            try:
+                for array_id, row_number, row in plan:
+                    acks = program_row_nowait(array_id, row_number, row.data, chunk_size)
+                    if verify_per_row:
+                        get_row_checksum_nowait(array_id, row_number)
+                    outstanding.append([array_id, row_number, row, acks + verify_per_row])
+                    if len(outstanding) >= window_size:
+                        i += 1
+                        read_row_responses(outstanding, verify_per_row)
+                        if i % step == 0 or i == total:
+                            progress_def("Uploading data", i, total)
+                while outstanding:
+                    i += 1
+                    read_row_responses(outstanding, verify_per_row)
+                    if i % step == 0 or i == total:
+                        progress_def("Uploading data", i, total)
+            finally:
+                # Leave the link in sync if a row failed
+                self.session.discard_responses(sum(request[3] for request in outstanding))
+
+        if self.verify_mode == VerifyMode.bulk:
+            self._verify_rows(plan)
+        elif self.verify_mode == VerifyMode.final_only:
+            if not self.session.verify_checksum():
+                # Find out which row failed, raises if one does
+                self._verify_rows(plan)
+                raise BootloaderHostError("Checksum Error")
+
+    def _verify_rows(self, plan):
+        """
+            Internal function that reads back and checks the checksum of every row in `plan`, keeping up to
+            window_size requests in flight
+
+            Raises:
+                BootloaderHostError: On the first row whose checksum doesn't match
+        """
+        for array_id, requests in itertools.groupby(plan, key=operator.itemgetter(0)):
+            requests = list(requests)
+            checksums = self.session.get_row_checksums_batch(array_id, [request[1] for request in requests],
+                                                             self.window_size)
+            for (_, row_number, row), actual_checksum in zip(requests, checksums):
+                self._check_row_checksum(array_id, row_number, row, actual_checksum)
+
+    def _read_row_responses(self, outstanding, verify):
+        """
+            Internal function that reads back the responses of the oldest row sent by :func:`write_rows`, and removes
+            it from `outstanding` once they are all read
+        """
+        request = outstanding[0]
+        array_id, row_number, row, _ = request
+        while request[3] > verify:
+            # Counted before reading, a response that fails to decode has still been read
+            request[3] -= 1
+            self.session.read_program_row_ack(1)
+        if verify:
+            request[3] -= 1
+            actual_checksum = self.session.read_row_checksum()
+        outstanding.popleft()
+        if verify:
+            self._check_row_checksum(array_id, row_number, row, actual_checksum)
+
+    def _check_row_checksum(self, array_id, row_number, row, actual_checksum):
+        """
+            Internal function that compares a row's checksum read from the device with the firmware's checksum
+
+            Raises:
+                BootloaderHostError: When the checksums don't match
+        """
+        if actual_checksum != row.checksum:
+            err = "Checksum does not match in array %d row %d. Expected %.2x, got %.2x! Aborting." % (
+                    array_id, row_number, row.checksum, actual_checksum)
+            self._log.error(err)
+            raise BootloaderHostError(err)
 
     def _progress(self, message=None, current=None, total=None):
         """
-            Internal progress function, if :func:`write_rows`'s `progress_def` input is None
+            Internal progress function, if :func:`write_rows`'s `progress_def` input is None. The progress is written
+            straight to stderr when it's a terminal, only the completion goes through the logger
         """
         if not message:
-            self._log.debug("\n")
-        else:
-            self._log.debug("\r%s (%d/%d)" % (message, current, total))
+            if self._progress_tty:
+                sys.stderr.write("\n")
+                sys.stderr.flush()
+            return
+        if self._progress_tty:
+            if current == 0:
+                # The starting count gets its own line instead of being drawn over by the first update
+                sys.stderr.write("%s (%d/%d)\n" % (message, current, total))
+            else:
+                # Clear to the end of the line, the previous update may have been longer
+                sys.stderr.write("\r%s (%d/%d)\x1b[K" % (message, current, total))
+                if current == total:
+                    sys.stderr.write("\n")
+            sys.stderr.flush()
+        if current == total:
+            self._log.debug("%s (%d/%d)", message, current, total)
@@ -0,0 +1,127 @@
+import io
+import unittest
+from unittest import mock
+
+from cyflash import bootload
+from cyflash import cyacd
+from cyflash import protocol
+from cyflash.protocol_test import FakeDevice
+
+
+def make_data(rows=20, row_size=64):
+    data = cyacd.BootloaderData()
+    data.checksum_type = cyacd.ChecksumType.sum_2complement
+    array = {}
+    for row_number in range(rows):
+        row = cyacd.BootloaderRow()
+        row.array_id = 0
+        row.row_number = row_number
+        row.data = bytes((row_number + i) & 0xFF for i in range(row_size))
+        array[row_number] = row
+    data.arrays = {0: array}
+    data.total_rows = rows
+    return data
+
+
+class WriteRowsTest(unittest.TestCase):
+    def flash(self, device, **kwargs):
+        data = make_data()
+        host = bootload.BootloaderHost(protocol.SerialTransport(device), data, **kwargs)
+        host.write_rows(lambda message, current, total: None)
+        self.assertEqual(device.flash, {(0, row_number): row.data for row_number, row in data.arrays[0].items()})
+
+    def testWindowOfOne(self):
+        device = FakeDevice()
+        self.flash(device, window_size=1)
+        self.assertEqual(device.max_unread, 1)
+
+    def testPipelinedWindow(self):
+        device = FakeDevice()
+        self.flash(device, window_size=4)
+        self.assertGreater(device.max_unread, 1)
+
+    def testPipelinedChecksumError(self):
+        device = FakeDevice(corrupt_rows=[(0, 5)])
+        host = bootload.BootloaderHost(protocol.SerialTransport(device), make_data(), window_size=4)
+        with self.assertRaisesRegex(bootload.BootloaderHostError, "array 0 row 5\\."):
+            host.write_rows(lambda message, current, total: None)
+        # The rows still in flight have been read back, the next command gets its own response
+        self.assertEqual(host.session.get_flash_size(0), (0, 255))
+
+    def testPipelinedRowError(self):
+        device = FakeDevice(invalid_rows=[(0, 5)])
+        host = bootload.BootloaderHost(protocol.SerialTransport(device), make_data(), window_size=4)
+        with self.assertRaises(protocol.InvalidFlashRow):
+            host.write_rows(lambda message, current, total: None)
+        self.assertEqual(host.session.get_flash_size(0), (0, 255))
+
+    def testDefaultWindow(self):
+        device = FakeDevice()
+        self.flash(device)
+        self.assertEqual(device.max_unread, 1)
+
+    def testPerRow(self):
+        device = FakeDevice()
+        self.flash(device, verify_mode='per_row')
+        verify_commands = [i for i, command in enumerate(device.commands)
+                           if command == protocol.VerifyRowCommand.COMMAND]
+        self.assertEqual(len(verify_commands), 20)
+        # Every row is verified right after its ProgramRow command
+        for i in verify_commands:
+            self.assertEqual(device.commands[i - 1], protocol.ProgramRowCommand.COMMAND)
+        self.assertNotIn(protocol.VerifyChecksumCommand.COMMAND, device.commands)
+
+    def testBulk(self):
+        device = FakeDevice()
+        self.flash(device, verify_mode='bulk', window_size=4)
+        first_verify = device.commands.index(protocol.VerifyRowCommand.COMMAND)
+        self.assertEqual(device.commands[:first_verify].count(protocol.ProgramRowCommand.COMMAND), 20)
+        self.assertEqual(device.commands[first_verify:], [protocol.VerifyRowCommand.COMMAND] * 20)
+
+    def testBulkChecksumError(self):
+        device = FakeDevice(corrupt_rows=[(0, 12)])
+        with self.assertRaisesRegex(bootload.BootloaderHostError, "array 0 row 12\\."):
+            self.flash(device, verify_mode='bulk')
+
+    def testFinalOnly(self):
+        device = FakeDevice()
+        self.flash(device, verify_mode='final_only')
+        self.assertNotIn(protocol.VerifyRowCommand.COMMAND, device.commands)
+        self.assertEqual(device.commands.count(protocol.VerifyChecksumCommand.COMMAND), 1)
+
+    def testFinalOnlyChecksumError(self):
+        device = FakeDevice(corrupt_rows=[(0, 7)])
+        with self.assertRaisesRegex(bootload.BootloaderHostError, "array 0 row 7\\."):
+            self.flash(device, verify_mode='final_only')
+
+
+
+class VerifyRowRangesTest(unittest.TestCase):
+    def testPipelinedError(self):
+        data = make_data()
+        data.arrays = {0: data.arrays[0], 1: {}, 2: {}}
+        device = FakeDevice(flash_sizes={0: (0, 255), 2: (0, 127)})
+        host = bootload.BootloaderHost(protocol.SerialTransport(device), data, window_size=4)
+        with self.assertRaises(protocol.InvalidArray):
+            host.verify_row_ranges()
+        # The query still in flight has been read back, the next command gets its own response
+        self.assertEqual(host.session.get_flash_size(0), (0, 255))
+
+
+class ProgressTest(unittest.TestCase):
+    def testTerminalProgress(self):
+        class Terminal(io.StringIO):
+            def isatty(self):
+                return True
+
+        with mock.patch('sys.stderr', Terminal()) as stderr:
+            host = bootload.BootloaderHost(protocol.SerialTransport(FakeDevice()), make_data(rows=3))
+            host.write_rows()
+        self.assertEqual(stderr.getvalue(),
+                         "Total Rows and Array (0/3)\n"
+                         "\rUploading data (1/3)\x1b[K"
+                         "\rUploading data (2/3)\x1b[K"
+                         "\rUploading data (3/3)\x1b[K\n")
+
+if __name__ == '__main__':
+    unittest.main()
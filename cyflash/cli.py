@@ -8,7 +8,6 @@ If you need to use this package in your own program, then use bootload.py
 import argparse
 import codecs
 import time
-import six
 import sys
 import logging
 import logging.config
@@ -70,6 +69,12 @@ parser.add_argument(
     '--rts',
     action='store_true',
     help="set RTS state true (default false)")
+parser.add_argument(
+    '--no-low-latency',
+    action='store_false',
+    dest='low_latency',
+    default=True,
+    help="Don't switch the serial port to low latency mode (Linux only)")
 parser.add_argument(
     '--canbus_baudrate',
     action='store',
@@ -108,7 +113,8 @@ group.add_argument(
     metavar='CANBUS_WAIT',
     default=5,
     type=int,
-    help="Wait for CANBUS_WAIT ms amount of time after sending a frame if you're not using echo frames as a way to keep host in sync")
+    help="Wait for CANBUS_WAIT ms amount of time after sending a frame (default 5). Only used without "
+         "--canbus_echo, echo frames keep the host in sync without any wait")
 
 parser.add_argument(
     '--timeout',
@@ -167,16 +173,8 @@ def validate_key(string):
         raise argparse.ArgumentTypeError("key is of unexpected length")
 
     try:
-        val = int(string, base=16)
-        key = []
-        key.append((val >> 40) & 0xff)
-        key.append((val >> 32) & 0xff)
-        key.append((val >> 24) & 0xff)
-        key.append((val >> 16) & 0xff)
-        key.append((val >> 8) & 0xff)
-        key.append(val & 0xff)
-        return key
-    except ValueError:
+        return list(int(string, base=16).to_bytes(6, 'big'))
+    except (ValueError, OverflowError):
         raise argparse.ArgumentTypeError("key is of unexpected format")
 
 
@@ -198,6 +196,26 @@ parser.add_argument(
     type=int,
     help="Chunk size to use for transfers - default %d" % DEFAULT_CHUNKSIZE)
 
+DEFAULT_WINDOW_SIZE = 1
+parser.add_argument(
+    '--window-size',
+    action='store',
+    dest='window_size',
+    default=DEFAULT_WINDOW_SIZE,
+    type=int,
+    help="Maximum number of rows in flight while flashing, 1 waits for every response. Larger windows are "
+         "experimental and untested on hardware - default %d"
+         % DEFAULT_WINDOW_SIZE)
+
+parser.add_argument(
+    '--verify-mode',
+    action='store',
+    dest='verify_mode',
+    default=None,
+    choices=[mode.value for mode in bootload.VerifyMode],
+    help="How to verify the written rows: per_row reads each row's checksum back, bulk reads them all back once "
+         "written, final_only only checks the application checksum (default per_row, final_only with --canbus_echo)")
+
 parser.add_argument(
     '--dual-app',
     action='store_true',
@@ -216,7 +234,6 @@ parser.add_argument(
 parser.add_argument(
     'image',
     action='store',
-    type=argparse.FileType(mode='r'),
     help="Image to read flash data from")
 
 
@@ -242,6 +259,8 @@ def get_transport(args):
         ser.rts = args.dtr
         ser.dtr = args.rts
         ser.open()
+        if args.low_latency:
+            set_low_latency(ser)
         ser.flushInput()  # need to clear any garbage off the serial port
         ser.flushOutput()
         transport = protocol.SerialTransport(ser)
@@ -259,6 +278,18 @@ def get_transport(args):
     return transport
 
 
+def set_low_latency(ser):
+    """
+    Sets the ASYNC_LOW_LATENCY flag on the serial port, the same as `setserial <port> low_latency`. USB-serial
+    converters such as FTDI otherwise hold small responses for their latency timer (16 ms by default).
+    Ports or platforms that don't support it are left untouched.
+    """
+    try:
+        ser.set_low_latency_mode(True)
+    except (AttributeError, NotImplementedError, IOError, ValueError):
+        logging.getLogger('cyflash-cli').debug("Low latency mode not supported on %s", ser.port)
+
+
 def seek_permission(argument, message):
     if argument is not None:
         return lambda remote, local: argument
@@ -290,20 +321,27 @@ def parity_convert(value):
 
 
 def main():
-    logging.basicConfig(level=logging.DEBUG)
-    logging.getLogger('cyflash-serial-transport').setLevel(logging.INFO)
     args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    logging.getLogger('cyflash-serial-transport').setLevel(logging.INFO)
 
     if args.logging_config:
         logging.config.fileConfig(args.logging_config)
 
-    if six.PY3:
-        t0 = time.perf_counter()
-    else:
-        t0 = time.clock()
-    data = cyacd.BootloaderData.read(args.image)
+    if args.window_size > 1:
+        logging.getLogger('cyflash-cli').warning(
+            "A window size of %d sends rows without waiting for the bootloader, this is experimental and untested on "
+            "hardware", args.window_size)
+
+    t0 = time.perf_counter()
+    try:
+        data = cyacd.BootloaderData.read_path(args.image)
+    except (OSError, ValueError) as e:
+        print("Unable to read image: {}".format(e))
+        return 1
     transport = get_transport(args)
-    session = bootload.BootloaderHost(transport, data, key=args.key)
+    session = bootload.BootloaderHost(transport, data, key=args.key, window_size=args.window_size,
+                                      verify_mode=args.verify_mode)
     try:
         session.enter_bootloader()
         # Verify that the firmware's rows
@@ -327,17 +365,16 @@ def main():
             pass
         # Write the data rows
         session.write_rows()
-        # Verifies the application checksum and that everything went thru just fine
-        session.verify_checksum()
+        # Verifies the application checksum and that everything went thru just fine, write_rows already did in
+        # final_only mode
+        if session.verify_mode is not bootload.VerifyMode.final_only:
+            session.verify_checksum()
         # Exit the bootloader
         session.exit_bootloader()
     except (protocol.BootloaderError, BootloaderError) as e:
         print("Unhandled error: {}".format(e.STATUS))
         return 1
-    if (six.PY3):
-        t1 = time.perf_counter()
-    else:
-        t1 = time.clock()
+    t1 = time.perf_counter()
     print("Total running time {0:02.2f}s".format(t1 - t0))
     return 0
 
@@ -1,13 +1,16 @@
 """
 A Python module to handle .cyacd firmware file generated from PSOC Creator
 """
-import codecs
-import six
+import binascii
+import collections
+import mmap
+import os
 import struct
 import typing
 from enum import Enum
 
-hex_decoder = codecs.getdecoder('hex')
+# Array ID, row number, data length
+_ROW_HEADER = struct.Struct('>BHH')
 
 
 class BootloaderRow(object):
@@ -19,21 +22,18 @@ class BootloaderRow(object):
     @classmethod
     def read(cls, data, line=None):
         self = cls()
-        if data[0] != ':':
+        if data[:1] not in (b':', ':'):
             raise ValueError("Bootloader rows must start with a colon")
-        data = hex_decoder(data[1:])[0]
-        self.array_id, self.row_number, data_length = struct.unpack('>BHH', data[:5])
-        self.data = data[5:-1]
-        if len(self.data) != data_length:
+        data = binascii.a2b_hex(data[1:])
+        self.array_id, self.row_number, data_length = _ROW_HEADER.unpack_from(data)
+        # Header and trailing checksum byte around the row data
+        if len(data) - 6 != data_length:
             raise ValueError("Row specified %d bytes of data, but got %d"
-                             % (data_length, len(self.data)))
-        # data is already a bytes object in Py3
-        if (six.PY2):
-            (checksum,) = struct.unpack('B', data[-1])
-            data_checksum = 0x100 - (sum(ord(x) for x in data[:-1]) & 0xFF)
-        elif (six.PY3):
-            checksum = data[-1]
-            data_checksum = 0x100 - (sum(data[:-1]) & 0xFF)
+                             % (data_length, len(data) - 6))
+        self.data = data[5:-1]
+        # Sum the whole row and take the checksum byte back out rather than copying data[:-1]
+        checksum = data[-1]
+        data_checksum = 0x100 - ((sum(data) - checksum) & 0xFF)
 
         if data_checksum == 0x100:
             data_checksum = 0
@@ -45,10 +45,6 @@ class BootloaderRow(object):
     @property
     def checksum(self):
         """Returns the data checksum. Should match what the bootloader returns."""
-        # Python2
-        if (six.PY2):
-            return 0xFF & (1 + ~sum(ord(x) for x in self.data))
-
         return (1 + ~sum(self.data)) & 0xFF
 
 
@@ -60,10 +56,11 @@ class ChecksumType(Enum):
 class BootloaderData(object):
     """
         The bootloader data object. This class is not to be directly created as an empty object, but
-        rather with the classmethod :func:`read`.
+        rather with the classmethods :func:`read` or :func:`read_path`.
 
         Examples:
             data = cyacd.BootloaderData.read(firmware_file)
+            data = cyacd.BootloaderData.read_path("firmware.cyacd")
     """
     def __init__(self):
         self.silicon_id = None          # type: int
@@ -82,39 +79,76 @@ class BootloaderData(object):
         """The total number of rows for the firmware's flash"""
 
     @classmethod
-    def read(cls, f: typing.TextIO):
+    def read(cls, f: typing.Union[typing.BinaryIO, typing.TextIO]):
         """
             The main invocation to create this class
 
             Args:
-                f: The firmware's file object
+                f: The firmware's file object. Opening it in binary mode skips the text decoding
 
             Returns:
                 A :class:`BootloaderData` object containing the read firmware file's data and info
 
             Raises:
-                UserWarning: If A) there is a Python 4 in the future, or B) The header of the firmware file is not of the
-                             correct length
+                ValueError: If the header of the firmware file is not of the correct length, or a row is corrupt
+        """
+        return cls._read_lines(iter(f))
+
+    @classmethod
+    def read_path(cls, path: str):
+        """
+            Same as :func:`read`, but reads the firmware file at `path` through a read-only memory map, letting the
+            kernel page the file in as it's parsed instead of going through a file object per line
+
+            Args:
+                path: The firmware file's path
+
+            Returns:
+                A :class:`BootloaderData` object containing the read firmware file's data and info
+        """
+        with open(path, 'rb') as fh:
+            # An empty file can't be mapped, parse it as having no lines to report the missing header
+            if os.fstat(fh.fileno()).st_size == 0:
+                return cls._read_lines(iter(()))
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return cls._read_lines(cls._mmap_lines(mm))
+
+    @staticmethod
+    def _mmap_lines(mm):
+        """
+            Internal generator that yields every line of a memory map as bytes, without the line ending
+        """
+        pos = 0
+        size = len(mm)
+        while pos < size:
+            nl = mm.find(b'\n', pos)
+            if nl < 0:
+                nl = size
+            yield mm[pos:nl]
+            pos = nl + 1
+
+    @classmethod
+    def _read_lines(cls, lines):
+        """
+            Internal function that parses the header line then the rows of a firmware file from an iterator of lines
         """
-        if six.PY2:
-            header = f.readline().strip().decode('hex')
-        elif six.PY3:
-            # header is a bytes instance
-            header = hex_decoder(f.readline().strip())[0]
-        else:
-            raise UserWarning("Unhandled future Python 4")
+        header = binascii.a2b_hex(next(lines, b'').strip())
 
         if len(header) != 6:
             raise ValueError("Expected 12 byte header line first, firmware file may be corrupt.")
         self = cls()
         self.silicon_id, self.silicon_rev, self.checksum_type = struct.unpack('>LBB', header)
         self.checksum_type = ChecksumType(self.checksum_type)
-        for i, line in enumerate(f):
-            row = BootloaderRow.read(line.strip(), i + 2)
-            if row.array_id not in self.arrays:
-                self.arrays[row.array_id] = {}
-            self.arrays[row.array_id][row.row_number] = row
-            self.total_rows += row.row_number
+        arrays = collections.defaultdict(dict)
+        total_rows = 0
+        read_row = BootloaderRow.read
+        for i, line in enumerate(lines):
+            row = read_row(line.strip(), i + 2)
+            arrays[row.array_id][row.row_number] = row
+            total_rows += 1
+        # Back to a plain dict so looking up a missing array still raises a KeyError
+        self.arrays = dict(arrays)
+        self.total_rows = total_rows
         return self
 
     def __str__(self):
@@ -1,28 +1,104 @@
-from cStringIO import StringIO
+from io import BytesIO, StringIO
+import os
+import tempfile
 import unittest
 
-import cyacd
+from cyflash import cyacd
+
+HEADER = "04A611931101"
+ROWS = [
+    ":000018008000100020110C0000E92D0000E92D000008B5024B83F3088802F0E8F800100020F8B572B6002406236343704D0134EE187279707831793778B3781202F67800020A4338431904084337063843002103F09FF8032CE7D1291C12316548802203F08EF80023191C634AFF25141C143418593C32061CAE434F00C4B2351CD219002CB8",
+    ":000019008007D0167857787619013C3770E4B20232F5E7C0B204330918282BE4D1564A574B574C584D584F59491A6099262C604F20574A584B584D3E600F240860574F58491A6003262C608720564B574C3E603C220860564DD82756491A6038012260554A2E60554B0860554C554D56481660C0270E2655491E6002222C6093260760534BB3",
+]
 
 
 class BootloaderRowTest(unittest.TestCase):
     def testParseRow(self):
-        rowdata = ":000018008000100020110C0000E92D0000E92D000008B5024B83F3088802F0E8F800100020F8B572B6002406236343704D0134EE187279707831793778B3781202F67800020A4338431904084337063843002103F09FF8032CE7D1291C12316548802203F08EF80023191C634AFF25141C143418593C32061CAE434F00C4B2351CD219002CB8"
+        rowdata = ROWS[0]
         blrow = cyacd.BootloaderRow.read(rowdata)
-        self.assertEquals(blrow.array_id, 0)
-        self.assertEquals(blrow.row_number, 0x18)
-        self.assertEquals(len(blrow.data), 0x80)
-        self.assertEquals(blrow.data.encode('hex').upper(), rowdata[11:-2])
+        self.assertEqual(blrow.array_id, 0)
+        self.assertEqual(blrow.row_number, 0x18)
+        self.assertEqual(len(blrow.data), 0x80)
+        self.assertEqual(blrow.data.hex().upper(), rowdata[11:-2])
+
+    def testParseBytesRow(self):
+        blrow = cyacd.BootloaderRow.read(ROWS[0].encode())
+        self.assertEqual(blrow.row_number, 0x18)
+        self.assertEqual(blrow.data.hex().upper(), ROWS[0][11:-2])
+
+    def testBadChecksum(self):
+        with self.assertRaises(ValueError):
+            cyacd.BootloaderRow.read(ROWS[0][:-2] + "00", 2)
+
+    def testMissingColon(self):
+        with self.assertRaises(ValueError):
+            cyacd.BootloaderRow.read(ROWS[0][1:])
+
+
+class BootloaderDataTest(unittest.TestCase):
+    def checkData(self, bldata):
+        self.assertEqual(bldata.silicon_id, 0x04A61193)
+        self.assertEqual(bldata.silicon_rev, 0x11)
+        self.assertEqual(bldata.checksum_type, cyacd.ChecksumType.crc16)
+        self.assertEqual(bldata.total_rows, 2)
+        self.assertEqual(list(bldata.arrays), [0])
+        self.assertEqual(list(bldata.arrays[0]), [0x18, 0x19])
+        self.assertTrue(all(isinstance(row, cyacd.BootloaderRow) for row in bldata.arrays[0].values()))
 
     def testParseFile(self):
-        filedata = """04A611931101
-:000018008000100020110C0000E92D0000E92D000008B5024B83F3088802F0E8F800100020F8B572B6002406236343704D0134EE187279707831793778B3781202F67800020A4338431904084337063843002103F09FF8032CE7D1291C12316548802203F08EF80023191C634AFF25141C143418593C32061CAE434F00C4B2351CD219002CB8
-:000019008007D0167857787619013C3770E4B20232F5E7C0B204330918282BE4D1564A574B574C584D584F59491A6099262C604F20574A584B584D3E600F240860574F58491A6003262C608720564B574C3E603C220860564DD82756491A6038012260554A2E60554B0860554C554D56481660C0270E2655491E6002222C6093260760534BB3"""
-        bldata = cyacd.BootloaderData.read(StringIO(filedata))
-        self.assertEquals(bldata.silicon_id, 0x04A61193)
-        self.assertEquals(bldata.silicon_rev, 0x11)
-        self.assertEquals(bldata.checksum_type, 0x01)
-        self.assertEquals(len(bldata.rows), 2)
-        self.assertTrue(all(isinstance(row, cyacd.BootloaderRow) for row in bldata.rows))
+        filedata = "\n".join([HEADER] + ROWS)
+        self.checkData(cyacd.BootloaderData.read(StringIO(filedata)))
+
+    def testParseBinaryFile(self):
+        filedata = "\n".join([HEADER] + ROWS) + "\n"
+        self.checkData(cyacd.BootloaderData.read(BytesIO(filedata.encode())))
+
+    def testParseCRLF(self):
+        filedata = "\r\n".join([HEADER] + ROWS) + "\r\n"
+        self.checkData(cyacd.BootloaderData.read(BytesIO(filedata.encode())))
+
+    def testEmptyFile(self):
+        with self.assertRaisesRegex(ValueError, "header"):
+            cyacd.BootloaderData.read(BytesIO(b""))
+
+    def testBadHeader(self):
+        with self.assertRaisesRegex(ValueError, "header"):
+            cyacd.BootloaderData.read(StringIO("\n".join([HEADER[:-2]] + ROWS)))
+
+
+class ReadPathTest(unittest.TestCase):
+    def readPath(self, filedata):
+        fd, path = tempfile.mkstemp(suffix='.cyacd')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(filedata.encode())
+            return cyacd.BootloaderData.read_path(path)
+        finally:
+            os.remove(path)
+
+    def testTrailingNewline(self):
+        bldata = self.readPath("\n".join([HEADER] + ROWS) + "\n")
+        self.assertEqual(bldata.total_rows, 2)
+        self.assertEqual(bldata.arrays[0][0x19].data.hex().upper(), ROWS[1][11:-2])
+
+    def testNoTrailingNewline(self):
+        bldata = self.readPath("\n".join([HEADER] + ROWS))
+        self.assertEqual(bldata.total_rows, 2)
+        self.assertEqual(bldata.arrays[0][0x19].data.hex().upper(), ROWS[1][11:-2])
+
+    def testCRLF(self):
+        bldata = self.readPath("\r\n".join([HEADER] + ROWS) + "\r\n")
+        self.assertEqual(bldata.silicon_id, 0x04A61193)
+        self.assertEqual(bldata.total_rows, 2)
+
+    def testHeaderOnly(self):
+        bldata = self.readPath(HEADER + "\n")
+        self.assertEqual(bldata.total_rows, 0)
+        self.assertEqual(bldata.arrays, {})
+
+    def testEmptyFile(self):
+        with self.assertRaisesRegex(ValueError, "header"):
+            self.readPath("")
 
 
 if __name__ == '__main__':
@@ -1,4 +1,6 @@
+import binascii
 import logging
+import operator
 import typing
 from builtins import super
 from builtins import range
@@ -7,6 +9,27 @@ import time
 
 from cyflash.cyacd import ChecksumType
 
+# Precompiled packet framing formats
+_RESPONSE_HEADER = struct.Struct("<BBH")    # Start of packet, status code, data length
+_COMMAND_HEADER = struct.Struct("<BH")      # Command code, data length
+_PACKET_TAIL = struct.Struct("<HB")         # Checksum, end of packet
+_UINT16 = struct.Struct("<H")
+
+# Every byte value with its bits reversed
+_BIT_REVERSE = bytes(int("{:08b}".format(b)[::-1], 2) for b in range(256))
+
+
+def _args_getter(args):
+    """
+        Returns a function that extracts the values of `args` from a keyword arguments dict as a tuple, in order
+    """
+    if len(args) > 1:
+        return operator.itemgetter(*args)
+    if args:
+        getter = operator.itemgetter(args[0])
+        return lambda kwargs: (getter(kwargs),)
+    return lambda kwargs: ()
+
 
 class InvalidPacketError(Exception):
     pass
@@ -98,40 +121,54 @@ class UnknownError(BootloaderError):
     STATUS = 0x0F
 
 
+_ERROR_CLASSES = (
+    BootloaderKeyError,
+    VerificationError,
+    IncorrectLength,
+    InvalidData,
+    InvalidCommand,
+    InvalidChecksum,
+    UnexpectedDevice,
+    UnsupportedBootloaderVersion,
+    InvalidArray,
+    InvalidFlashRow,
+    ProtectedFlash,
+    InvalidApp,
+    TargetApplicationIsActive,
+    CallbackResponseInvalid,
+    UnknownError
+)
+
+# The error class of every status code, indexed by the status code. The codes are the dense range 0x01-0x0F
+_STATUS_ERRORS = tuple(next((klass for klass in _ERROR_CLASSES if klass.STATUS == status), None)
+                       for status in range(0x10))
+
+
 class BootloaderResponse(object):
     FORMAT = ""
     ARGS = ()
+    _struct = struct.Struct(FORMAT)
 
-    ERRORS = {klass.STATUS: klass for klass in [
-        BootloaderKeyError,
-        VerificationError,
-        IncorrectLength,
-        InvalidData,
-        InvalidCommand,
-        InvalidChecksum,
-        UnexpectedDevice,
-        UnsupportedBootloaderVersion,
-        InvalidArray,
-        InvalidFlashRow,
-        ProtectedFlash,
-        InvalidApp,
-        TargetApplicationIsActive,
-        CallbackResponseInvalid,
-        UnknownError
-    ]}
+    ERRORS = {klass.STATUS: klass for klass in _ERROR_CLASSES}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._struct = struct.Struct(cls.FORMAT)
 
     def __init__(self, data):
         try:
-            unpacked = struct.unpack(self.FORMAT, data)
+            unpacked = self._struct.unpack(data)
         except struct.error as e:
-            raise InvalidPacketError("Cannot unpack packet data '{}': {}".format(data, e))
+            raise InvalidPacketError("Cannot unpack packet data '{}': {}".format(bytes(data), e))
         for arg, value in zip(self.ARGS, unpacked):
             if arg:
                 setattr(self, arg, value)
 
     @classmethod
     def decode(cls, data, checksum_func):
-        start, status, length = struct.unpack("<BBH", data[:4])
+        # Only views of the packet are taken, the response fields are unpacked straight from it
+        data = memoryview(data)
+        start, status, length = _RESPONSE_HEADER.unpack_from(data, 0)
         if start != 0x01:
             raise InvalidPacketError("Expected Start Of Packet signature 0x01, found 0x{0:01X}".format(start))
 
@@ -139,11 +176,10 @@ class BootloaderResponse(object):
         if length != expected_dlen:
             raise InvalidPacketError("Expected packet data length {} actual {}".format(length, expected_dlen))
 
-        checksum, end = struct.unpack("<HB", data[-3:])
-        data = data[:length + 4]
+        checksum, end = _PACKET_TAIL.unpack_from(data, len(data) - 3)
         if end != 0x17:
             raise InvalidPacketError("Invalid end of packet code 0x{0:02X}, expected 0x17".format(end))
-        calculated_checksum = checksum_func(data)
+        calculated_checksum = checksum_func(data[:length + 4])
         if checksum != calculated_checksum:
             raise InvalidPacketError(
                 "Invalid packet checksum 0x{0:02X}, expected 0x{1:02X}".format(checksum, calculated_checksum))
@@ -152,14 +188,13 @@ class BootloaderResponse(object):
         # TODO Handle status 0x0D: The application is currently marked as active
 
         if (status != 0x00):
-            response_class = cls.ERRORS.get(status)
+            response_class = _STATUS_ERRORS[status] if status < 0x10 else None
             if response_class:
                 raise response_class()
             else:
                 raise InvalidPacketError("Unknown status code 0x{0:02X}".format(status))
 
-        data = data[4:]
-        return cls(data)
+        return cls(data[4:length + 4])
 
 
 class BootloaderCommand(object):
@@ -167,16 +202,25 @@ class BootloaderCommand(object):
     FORMAT = ""
     ARGS = ()
     RESPONSE = None
+    _struct = struct.Struct(FORMAT)
+    _arg_set = frozenset(ARGS)
+    _get_args = staticmethod(_args_getter(ARGS))
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._struct = struct.Struct(cls.FORMAT)
+        cls._arg_set = frozenset(cls.ARGS)
+        cls._get_args = staticmethod(_args_getter(cls.ARGS))
 
     def __init__(self, **kwargs):
-        for arg in kwargs:
-            if arg not in self.ARGS:
-                raise TypeError("Argument {} not in command arguments".format(arg))
-        self.args = [kwargs[arg] for arg in self.ARGS]
+        extra = kwargs.keys() - self._arg_set
+        if extra:
+            raise TypeError("Argument {} not in command arguments".format(min(extra)))
+        self.args = self._get_args(kwargs)
 
     @property
     def data(self):
-        return struct.pack(self.FORMAT, *self.args)
+        return self._struct.pack(*self.args)
 
 
 class BooleanResponse(BootloaderResponse):
@@ -266,8 +310,8 @@ class EnterBootloaderCommand(BootloaderCommand):
     def data(self):
         if self._key is None:
             return super(EnterBootloaderCommand, self).data
-        return super(EnterBootloaderCommand, self).data + struct.pack("<BBBBBB",
-                                                                      *self._key)
+        # The key is six single bytes, no packing needed
+        return super(EnterBootloaderCommand, self).data + bytes(self._key)
 
 
 class ProgramRowCommand(BootloaderCommand):
@@ -373,6 +417,11 @@ class SerialTransport(object):
     """
         A serial transport
     """
+    CONCATENATE_PACKETS = True
+    """The serial line is a byte stream, so several packets can be sent in a single write"""
+    PIPELINING = True
+    """Responses are buffered by the port, so further packets can be sent before reading them"""
+
     def __init__(self, f):
         """
             Args:
@@ -383,18 +432,18 @@ class SerialTransport(object):
         self._log = logging.getLogger('cyflash-serial-transport')
 
     def send(self, data):
-        for part in bytearray(data):
-            self._log.debug("Sent out: 0x{:02x}".format(part))
+        if self._log.isEnabledFor(logging.DEBUG):
+            self._log.debug("Sent out: %s", bytes(data).hex())
         self.f.write(data)
 
     def recv(self):
         data = self.f.read(4)
         if len(data) < 4:
             raise BootloaderTimeoutError("Timed out waiting for Bootloader response.")
-        size = struct.unpack("<H", data[-2:])[0]
+        size = _UINT16.unpack_from(data, 2)[0]
         data += self.f.read(size + 3)
-        for part in bytearray(data):
-            self._log.debug("Read: 0x{:02x}".format(part))
+        if self._log.isEnabledFor(logging.DEBUG):
+            self._log.debug("Read: %s", bytes(data).hex())
         if len(data) < size + 7:
             raise BootloaderTimeoutError("Timed out waiting for Bootloader response.")
         return data
@@ -402,55 +451,50 @@ class SerialTransport(object):
 
 class CANbusTransport(object):
     MESSAGE_CLASS = None
+    CONCATENATE_PACKETS = False
+    """Every packet must start on a new CAN frame"""
+    PIPELINING = False
+    """Sending flushes the receive mailboxes and skips frames while waiting for echoes, so every response must be
+    read before the next packet is sent"""
 
     def __init__(self, transport, frame_id, timeout, echo_frames, wait_send_ms):
         self.transport = transport
         self.frame_id = frame_id
         self.timeout = timeout
         self.echo_frames = echo_frames
-        self.wait_send_s = wait_send_ms / 1000.0
+        # With echo frames the device paces the host, frames are sent back to back without waiting
+        self.wait_send_s = 0.0 if echo_frames else wait_send_ms / 1000.0
         self._last_sent_frame = None
 
     def send(self, data):
-        start = 0
-        maxlen = len(data)
-        while (start < maxlen):
-            remaining = maxlen - start
+        # Flush input mailbox(es), once per packet since no response is expected before the packet is complete
+        while (self.transport.recv(timeout=0)):
+            pass
 
-            if (remaining > 8):
-                msg = self.MESSAGE_CLASS(
-                    extended_id=False,
-                    arbitration_id=self.frame_id,
-                    data=data[start:start + 8]
-                )
-            else:
+        with memoryview(data) as view:
+            for start in range(0, len(view), 8):
                 msg = self.MESSAGE_CLASS(
                     extended_id=False,
                     arbitration_id=self.frame_id,
-                    data=data[start:]
+                    data=bytes(view[start:start + 8])
                 )
 
-            # Flush input mailbox(es)
-            while (self.transport.recv(timeout=0)):
-                pass
-
-            self.transport._send(msg)
-            self._last_sent_frame = msg
-            if (self.echo_frames):
-                # Read back the echo message
-                while (True):
-                    frame = self.transport.recv(self.timeout)
-                    if (not frame):
-                        raise BootloaderTimeoutError("Did not receive echo frame within {} timeout".format(self.timeout))
-                    # Don't check the frame arbitration ID, it may be used for varying purposes
-                    if (frame.data[:frame.dlc] != msg.data[:msg.dlc]):
-                        continue
-                    # Ok, got a good frame
-                    break
-            elif (self.wait_send_s > 0.0):
-                time.sleep(self.wait_send_s)
-
-            start += 8
+                self.transport._send(msg)
+                self._last_sent_frame = msg
+                if (self.echo_frames):
+                    # Read back the echo message
+                    while (True):
+                        frame = self.transport.recv(self.timeout)
+                        if (not frame):
+                            raise BootloaderTimeoutError(
+                                "Did not receive echo frame within {} timeout".format(self.timeout))
+                        # Don't check the frame arbitration ID, it may be used for varying purposes
+                        if (frame.data[:frame.dlc] != msg.data[:msg.dlc]):
+                            continue
+                        # Ok, got a good frame
+                        break
+                elif (self.wait_send_s > 0.0):
+                    time.sleep(self.wait_send_s)
 
     def recv(self):
         # Response packets read from the Bootloader have the following structure:
@@ -484,7 +528,7 @@ class CANbusTransport(object):
         data += frame.data[:frame.dlc]
 
         # 4 initial bytes, reported size, 3 tail
-        total_size = 4 + (struct.unpack("<H", data[2:4])[0]) + 3
+        total_size = 4 + (_UINT16.unpack_from(data, 2)[0]) + 3
         while len(data) < total_size:
             frame = self.transport.recv(self.timeout)
             if not frame:
@@ -552,6 +596,20 @@ class BootloaderSession(object):
         response = self._send(GetFlashSizeCommand(array_id=array_id))
         return response.first_row, response.last_row
 
+    def get_flash_size_nowait(self, array_id):
+        """
+            Requests a flash array's size without waiting for the response, which must later be collected in order
+            with :func:`read_flash_size`
+        """
+        self._send(GetFlashSizeCommand(array_id=array_id), read=False)
+
+    def read_flash_size(self):
+        """
+            Reads the response of a flash size requested with :func:`get_flash_size_nowait`
+        """
+        response = self._recv(GetFlashSizeCommand.RESPONSE)
+        return response.first_row, response.last_row
+
     def verify_checksum(self):
         return bool(self._send(VerifyChecksumCommand()).status)
 
@@ -562,10 +620,44 @@ class BootloaderSession(object):
         return self._send(GetPSOC5MetadataCommand(application_id=application_id))
 
     def program_row(self, array_id, row_id, rowdata, chunk_size):
+        for packet in self._row_packets(array_id, row_id, rowdata, chunk_size):
+            self.transport.send(packet)
+            self._recv(ProgramRowCommand.RESPONSE)
+
+    def program_row_nowait(self, array_id, row_id, rowdata, chunk_size):
+        """
+            Sends all the packets needed to program a row without waiting for the bootloader's acknowledgements.
+            The acknowledgements must later be collected in order with :func:`read_program_row_ack`
+
+            Returns:
+                The number of acknowledgements pending for this row
+        """
+        packets = self._row_packets(array_id, row_id, rowdata, chunk_size)
+        if getattr(self.transport, 'CONCATENATE_PACKETS', False):
+            self.transport.send(b"".join(packets))
+        else:
+            for packet in packets:
+                self.transport.send(packet)
+        return len(packets)
+
+    def _row_packets(self, array_id, row_id, rowdata, chunk_size):
+        """
+            Internal function that frames all the SendData packets and the final ProgramRow packet of a row
+        """
         chunked = [rowdata[i:i + chunk_size] for i in range(0, len(rowdata), chunk_size)]
-        for chunk in chunked[0:-1]:
-            self._send(SendDataCommand(chunk))
-        self._send(ProgramRowCommand(chunked[-1], array_id=array_id, row_id=row_id))
+        packets = [self._packet(SendDataCommand(chunk)) for chunk in chunked[0:-1]]
+        packets.append(self._packet(ProgramRowCommand(chunked[-1], array_id=array_id, row_id=row_id)))
+        return packets
+
+    def read_program_row_ack(self, count):
+        """
+            Reads the acknowledgements of a row sent with :func:`program_row_nowait`
+
+            Args:
+                count (int): The number of acknowledgements returned by :func:`program_row_nowait`
+        """
+        for _ in range(count):
+            self._recv(ProgramRowCommand.RESPONSE)
 
     def erase_row(self, array_id, row_id):
         self._send(EraseRowCommand(array_id=array_id, row_id=row_id))
@@ -573,43 +665,101 @@ class BootloaderSession(object):
     def get_row_checksum(self, array_id, row_id):
         return self._send(VerifyRowCommand(array_id=array_id, row_id=row_id)).checksum
 
+    def get_row_checksum_nowait(self, array_id, row_id):
+        """
+            Requests a row checksum without waiting for the response, which must later be collected in order with
+            :func:`read_row_checksum`
+        """
+        self._send(VerifyRowCommand(array_id=array_id, row_id=row_id), read=False)
+
+    def read_row_checksum(self):
+        """
+            Reads the response of a checksum requested with :func:`get_row_checksum_nowait`
+        """
+        return self._recv(VerifyRowCommand.RESPONSE).checksum
+
+    def get_row_checksums_batch(self, array_id, row_ids, depth=1):
+        """
+            Gets the checksums of several rows of a flash array, keeping up to `depth` requests in flight so the
+            link's round trip is paid once per batch instead of once per row. Transports that don't support
+            pipelining use a depth of 1
+
+            Args:
+                array_id (int): The flash array ID
+                row_ids: The row numbers to read the checksums of
+                depth (int): The maximum number of requests in flight. Defaults to 1
+
+            Returns:
+                A list of the checksums, in the order of `row_ids`
+        """
+        if not getattr(self.transport, 'PIPELINING', False):
+            depth = 1
+        checksums = []
+        pending = 0
+        try:
+            for row_id in row_ids:
+                self.get_row_checksum_nowait(array_id, row_id)
+                pending += 1
+                if pending >= depth:
+                    pending -= 1
+                    checksums.append(self.read_row_checksum())
+            while pending:
+                pending -= 1
+                checksums.append(self.read_row_checksum())
+        finally:
+            # Leave the link in sync if a response failed
+            self.discard_responses(pending)
+        return checksums
+
+    def discard_responses(self, count):
+        """
+            Reads and drops up to `count` responses still in flight, so the next command reads its own response
+            after an error. Stops at the first response that can't be read
+        """
+        for _ in range(count):
+            try:
+                self.transport.recv()
+            except BootloaderError:
+                break
+
     def set_application_active(self, application_id):
         self._send(SetAppActive(application_id=application_id))
 
     def _send(self, command, read=True):
         """
-            Internal function that structures the data to be sent over the transport
+            Internal function that sends a command over the transport and optionally reads its response
         """
-        data = command.data
-        packet = b"\x01" + struct.pack("<BH", command.COMMAND, len(data)) + data
-        packet = packet + struct.pack('<H', self.checksum_func(packet)) + b"\x17"
-        self.transport.send(packet)
+        self.transport.send(self._packet(command))
         if read:
-            response = self.transport.recv()
-            return command.RESPONSE.decode(response, self.checksum_func)
+            return self._recv(command.RESPONSE)
         else:
             return None
 
+    def _packet(self, command):
+        """
+            Internal function that structures the data to be sent over the transport
+        """
+        data = command.data
+        packet = b"\x01" + _COMMAND_HEADER.pack(command.COMMAND, len(data)) + data
+        return packet + _PACKET_TAIL.pack(self.checksum_func(packet), 0x17)
+
+    def _recv(self, response_class):
+        """
+            Internal function that reads and decodes a response from the transport
+        """
+        response = self.transport.recv()
+        return response_class.decode(response, self.checksum_func)
+
     @staticmethod
     def crc16_checksum(data):
-        crc = 0xffff
-
-        for b in data:
-            if not isinstance(b, int):
-                b = ord(b)
-            for i in range(8):
-                if (crc & 1) ^ (b & 1):
-                    crc = (crc >> 1) ^ 0x8408
-                else:
-                    crc >>= 1
-                b >>= 1
-
-        crc = (crc << 8) | (crc >> 8)
+        # The bootloader uses the reflected form (0x8408) of the CCITT polynomial that binascii.crc_hqx computes in C.
+        # Reflecting the input bytes and the resulting register gives the same CRC, and reflecting the register
+        # followed by the bootloader's byte swap amounts to reflecting each byte in place
+        crc = binascii.crc_hqx(bytes(data).translate(_BIT_REVERSE), 0xffff)
+        crc = (_BIT_REVERSE[crc >> 8] << 8) | _BIT_REVERSE[crc & 0xff]
         return ~crc & 0xffff
 
     @staticmethod
     def sum_2complement_checksum(data):
-        if type(data) is str:
-            return (1 + ~sum([ord(c) for c in data])) & 0xFFFF
-        elif type(data) in (bytearray, bytes):
-            return (1 + ~sum(data)) & 0xFFFF
+        # Summing over bytes is faster than iterating a memoryview, and accepts any buffer
+        return (1 + ~sum(bytes(data))) & 0xFFFF
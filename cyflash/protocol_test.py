@@ -0,0 +1,191 @@
+import collections
+import random
+import struct
+import unittest
+
+from cyflash import cyacd
+from cyflash import protocol
+
+
+class FakeDevice(object):
+    """
+        A bootloader simulated behind a byte stream, to be wrapped in a SerialTransport. Responses are queued in
+        order as the packets are written, like a serial port buffers them
+    """
+    def __init__(self, checksum_type=cyacd.ChecksumType.sum_2complement, flash_sizes=None, corrupt_rows=(),
+                 invalid_rows=()):
+        session = protocol.BootloaderSession(protocol.SerialTransport(self), checksum_type)
+        self.checksum_func = session.checksum_func
+        self.flash_sizes = flash_sizes or {0: (0, 255)}
+        self.corrupt_rows = set(corrupt_rows)
+        # Rows answered with an InvalidFlashRow status
+        self.invalid_rows = set(invalid_rows)
+        self.flash = {}
+        self.commands = []
+        self.max_unread = 0
+        self._in = bytearray()
+        self._out = bytearray()
+        # The number of unread bytes of every queued response
+        self._unread = collections.deque()
+        self._row_data = bytearray()
+
+    def write(self, data):
+        self._in += data
+        while len(self._in) >= 7:
+            length = struct.unpack_from('<H', self._in, 2)[0]
+            if len(self._in) < length + 7:
+                break
+            packet, self._in = bytes(self._in[:length + 7]), self._in[length + 7:]
+            assert packet[0] == 0x01 and packet[-1] == 0x17
+            assert struct.unpack_from('<H', packet, length + 4)[0] == self.checksum_func(packet[:length + 4])
+            self._handle(packet[1], packet[4:length + 4])
+
+    def read(self, size):
+        data, self._out = bytes(self._out[:size]), self._out[size:]
+        for _ in range(len(data)):
+            self._unread[0] -= 1
+            if self._unread[0] == 0:
+                self._unread.popleft()
+        return data
+
+    def _handle(self, command, data):
+        self.commands.append(command)
+        if command == protocol.SendDataCommand.COMMAND:
+            self._row_data += data
+            self._respond(b'')
+        elif command == protocol.ProgramRowCommand.COMMAND:
+            array_id, row_id = struct.unpack_from('<BH', data)
+            row_data, self._row_data = bytes(self._row_data + data[3:]), bytearray()
+            if (array_id, row_id) in self.invalid_rows:
+                self._respond(b'', protocol.InvalidFlashRow.STATUS)
+                return
+            self.flash[array_id, row_id] = row_data
+            self._respond(b'')
+        elif command == protocol.VerifyRowCommand.COMMAND:
+            array_id, row_id = struct.unpack_from('<BH', data)
+            if (array_id, row_id) in self.invalid_rows:
+                self._respond(b'', protocol.InvalidFlashRow.STATUS)
+                return
+            checksum = (1 + ~sum(self.flash.get((array_id, row_id), b''))) & 0xFF
+            if (array_id, row_id) in self.corrupt_rows:
+                checksum ^= 0xFF
+            self._respond(bytes([checksum]))
+        elif command == protocol.VerifyChecksumCommand.COMMAND:
+            self._respond(bytes([0 if self.corrupt_rows else 1]))
+        elif command == protocol.GetFlashSizeCommand.COMMAND:
+            if data[0] not in self.flash_sizes:
+                self._respond(b'', protocol.InvalidArray.STATUS)
+                return
+            self._respond(struct.pack('<HH', *self.flash_sizes[data[0]]))
+        else:
+            raise AssertionError("Unexpected command 0x%.2x" % command)
+
+    def _respond(self, data, status=0x00):
+        packet = struct.pack('<BBH', 0x01, status, len(data)) + data
+        packet += struct.pack('<HB', self.checksum_func(packet), 0x17)
+        self._out += packet
+        self._unread.append(len(packet))
+        self.max_unread = max(self.max_unread, len(self._unread))
+
+
+def reference_crc16(data):
+    """The bit-serial CRC-16 of the Cypress bootloader host"""
+    crc = 0xffff
+    for b in data:
+        for i in range(8):
+            if (crc & 1) ^ (b & 1):
+                crc = (crc >> 1) ^ 0x8408
+            else:
+                crc >>= 1
+            b >>= 1
+    crc = (crc << 8) | (crc >> 8)
+    return ~crc & 0xffff
+
+
+class Crc16ChecksumTest(unittest.TestCase):
+    def testVectors(self):
+        crc16 = protocol.BootloaderSession.crc16_checksum
+        self.assertEqual(crc16(b''), 0x0000)
+        self.assertEqual(crc16(b'\x00'), 0x78F0)
+        self.assertEqual(crc16(b'123456789'), 0x6E90)
+        self.assertEqual(crc16(b'\x01\x38\x00\x00'), 0x09A0)
+        self.assertEqual(crc16(bytes(range(256))), 0x3C30)
+
+    def testReference(self):
+        crc16 = protocol.BootloaderSession.crc16_checksum
+        rng = random.Random(0)
+        for length in list(range(20)) + [64, 128, 263, 300]:
+            data = bytes(rng.getrandbits(8) for _ in range(length))
+            self.assertEqual(crc16(data), reference_crc16(data), data.hex())
+
+    def testBuffers(self):
+        data = bytearray(b'\x01\x39\x03\x00\x00\x10\x00')
+        expected = reference_crc16(data)
+        crc16 = protocol.BootloaderSession.crc16_checksum
+        self.assertEqual(crc16(data), expected)
+        self.assertEqual(crc16(memoryview(data)), expected)
+
+
+class NowaitTest(unittest.TestCase):
+    def testProgramRowNowait(self):
+        device = FakeDevice()
+        session = protocol.BootloaderSession(protocol.SerialTransport(device), cyacd.ChecksumType.sum_2complement)
+        rows = {row_id: bytes([row_id]) * 64 for row_id in range(3)}
+        acks = [session.program_row_nowait(0, row_id, data, 25) for row_id, data in rows.items()]
+        for row_id in rows:
+            session.get_row_checksum_nowait(0, row_id)
+        self.assertEqual(acks, [3, 3, 3])
+        self.assertEqual(device.max_unread, 12)
+        for count in acks:
+            session.read_program_row_ack(count)
+        checksums = [session.read_row_checksum() for _ in rows]
+        self.assertEqual(device.flash, {(0, row_id): data for row_id, data in rows.items()})
+        self.assertEqual(checksums, [(1 + ~sum(data)) & 0xFF for data in rows.values()])
+
+
+class RowChecksumsBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.device = FakeDevice()
+        for row_id in range(10):
+            self.device.flash[0, row_id] = bytes([row_id]) * 16
+        self.expected = [(1 + ~(row_id * 16)) & 0xFF for row_id in range(10)]
+
+    def testInOrder(self):
+        session = protocol.BootloaderSession(protocol.SerialTransport(self.device), cyacd.ChecksumType.sum_2complement)
+        self.assertEqual(session.get_row_checksums_batch(0, range(10), depth=1), self.expected)
+        self.assertEqual(self.device.max_unread, 1)
+
+    def testPipelined(self):
+        session = protocol.BootloaderSession(protocol.SerialTransport(self.device), cyacd.ChecksumType.sum_2complement)
+        self.assertEqual(session.get_row_checksums_batch(0, range(10), depth=3), self.expected)
+        self.assertEqual(self.device.max_unread, 3)
+
+    def testErrorDrainsPipeline(self):
+        self.device.invalid_rows.add((0, 4))
+        session = protocol.BootloaderSession(protocol.SerialTransport(self.device), cyacd.ChecksumType.sum_2complement)
+        with self.assertRaises(protocol.InvalidFlashRow):
+            session.get_row_checksums_batch(0, range(10), depth=4)
+        # The requests still in flight have been read back, the next command gets its own response
+        self.assertEqual(session.get_flash_size(0), (0, 255))
+
+    def testUnpipelinedTransport(self):
+        class Transport(protocol.SerialTransport):
+            PIPELINING = False
+
+        session = protocol.BootloaderSession(Transport(self.device), cyacd.ChecksumType.sum_2complement)
+        self.assertEqual(session.get_row_checksums_batch(0, range(10), depth=3), self.expected)
+        self.assertEqual(self.device.max_unread, 1)
+
+    def testTransportWithoutCapabilityFlags(self):
+        class Transport(object):
+            send = protocol.SerialTransport.send
+            recv = protocol.SerialTransport.recv
+            __init__ = protocol.SerialTransport.__init__
+
+        session = protocol.BootloaderSession(Transport(self.device), cyacd.ChecksumType.sum_2complement)
+        self.assertEqual(session.get_row_checksums_batch(0, range(10), depth=3), self.expected)
+        self.assertEqual(self.device.max_unread, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()